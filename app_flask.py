@@ -1,56 +1,214 @@
-import os, sqlite3, re
+import os, sqlite3, re, io, shutil, subprocess, threading, multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from functools import lru_cache
 from datetime import datetime
 from typing import List, Dict, Tuple
 
-from flask import Flask, render_template, request, redirect, url_for, flash
+import numpy as np
+
+from flask import Flask, render_template, request, redirect, url_for, flash, g, has_app_context
 from pypdf import PdfReader
+try:
+    import pymupdf      # C-backed extraction; much faster than pypdf
+except ImportError:
+    pymupdf = None
 from groq import Groq
 import traceback
 
-from math import log
-
-def build_corpus(rows):
-    # rows: list of sqlite rows with fields: source, page, chunk
-    docs = []
-    for r in rows:
-        toks = tokenize(r["chunk"])
-        docs.append({"row": r, "tokens": toks, "len": len(toks)})
-    return docs
-
-def bm25_rank(query_tokens, docs, k1=1.5, b=0.75, topk=4):
-    # Precompute DF and IDF
-    N = len(docs) or 1
-    df = {}
-    for d in docs:
-        for t in set(d["tokens"]):
-            df[t] = df.get(t, 0) + 1
-    idf = {t: log( (N - df_t + 0.5) / (df_t + 0.5) + 1 ) for t, df_t in df.items()}
-    avgdl = (sum(d["len"] for d in docs) / N) if N else 1.0
-
-    scores = []
-    for d in docs:
-        # term frequency map
-        tf = {}
-        for t in d["tokens"]:
-            tf[t] = tf.get(t, 0) + 1
-        s = 0.0
-        for q in set(query_tokens):
-            if q not in tf:
-                continue
-            q_idf = idf.get(q, 0.0)
-            numer = tf[q] * (k1 + 1.0)
-            denom = tf[q] + k1 * (1.0 - b + b * (d["len"] / avgdl))
-            s += q_idf * (numer / denom)
-        scores.append((s, d["row"]))
-    scores.sort(key=lambda x: x[0], reverse=True)
-    # Keep only the best chunk per (source,page)
-    best_per_page = {}
-    for s, r in scores:
-        key = (r["source"], r["page"])
-        if key not in best_per_page:
-            best_per_page[key] = (s, r)
-    ranked = sorted(best_per_page.values(), key=lambda x: x[0], reverse=True)[:topk]
-    return [{"source": r["source"], "page": r["page"], "chunk": r["chunk"], "score": round(s,4)} for s, r in ranked]
+# BM25 statistics: cached across queries, rebuilt lazily after the KB changes.
+# DF itself is maintained incrementally in the `term_vocab` table at ingest.
+# Requests run on threads: readers take a snapshot under _KB_LOCK, writers swap it out.
+_KB_LOCK = threading.Lock()
+_STATS: Tuple[Dict[str, int], np.ndarray, float] | None = None    # (term -> id, idf by term id, avgdl)
+_CORPUS_VERSION = 0     # bumped on every insert/clear
+
+def _rebuild_stats(c) -> Tuple[Dict[str, int], np.ndarray, float]:
+    n, avgdl = c.execute("SELECT COUNT(*), AVG(n_tokens) FROM chunks").fetchone()
+    rows = c.execute("SELECT id, term, df FROM term_vocab").fetchall()
+    N = n or 1
+    vocab = {r["term"]: r["id"] for r in rows}
+    ids = np.array([r["id"] for r in rows], dtype=np.int64)
+    df = np.array([r["df"] for r in rows], dtype=np.float64)
+    idf = np.zeros(int(ids.max()) + 1 if len(ids) else 0)
+    idf[ids] = np.log( (N - df + 0.5) / (df + 0.5) + 1 )
+    return vocab, idf, avgdl or 1.0
+
+def _kb_changed():
+    global _STATS, _CORPUS_VERSION
+    with _KB_LOCK:
+        _STATS = None
+        drop_corpus()
+        # last: anything cached under the new version was computed from the new KB
+        _CORPUS_VERSION += 1
+
+@dataclass
+class Corpus:
+    # Structure-of-arrays view of the stored chunk tokens; index i is the i-th chunk
+    doc_ids: np.ndarray   # int32 chunk id
+    lens: np.ndarray      # float32 token count
+    pages: np.ndarray     # int32 (source,page) group
+    # CSR postings: term id t owns post_docs/post_tfs[offsets[t]:offsets[t+1]]
+    offsets: np.ndarray   # int64, one past the largest term id + 1
+    post_docs: np.ndarray # int32 doc index, ascending within a term
+    post_tfs: np.ndarray  # float32 tf
+
+    def postings(self, t: int) -> Tuple[np.ndarray, np.ndarray]:
+        if t + 1 >= len(self.offsets):
+            return self.post_docs[:0], self.post_tfs[:0]
+        s, e = self.offsets[t], self.offsets[t + 1]
+        return self.post_docs[s:e], self.post_tfs[s:e]
+
+_CORPUS: Corpus | None = None
+
+def build_corpus(c) -> Corpus:
+    # single pass over the cursor; token ids go straight into one buffer
+    groups, ids, pages, lens, buf = {}, [], [], [], bytearray()
+    for cid, source, page, tokens, n_tokens in c.execute(
+            "SELECT id, source, page, tokens, n_tokens FROM chunks ORDER BY id"):
+        ids.append(cid)
+        pages.append(groups.setdefault((source, page), len(groups)))
+        lens.append(n_tokens)
+        buf += tokens
+    N = len(ids)
+    lens = np.array(lens, dtype=np.int64)
+    toks = np.frombuffer(buf, dtype=np.uint32)
+    # one (term, doc) key per token; np.unique counts tf and sorts by term, then doc
+    keys, tfs = np.unique(toks.astype(np.int64) * max(N, 1) + np.repeat(np.arange(N), lens), return_counts=True)
+    del buf, toks
+    terms = keys // max(N, 1)
+    offsets = np.zeros(int(terms.max()) + 2 if len(terms) else 1, dtype=np.int64)
+    np.cumsum(np.bincount(terms, minlength=len(offsets) - 1), out=offsets[1:])
+    return Corpus(
+        doc_ids=np.array(ids, dtype=np.int32),
+        lens=lens.astype(np.float32),
+        pages=np.array(pages, dtype=np.int32),
+        offsets=offsets,
+        post_docs=(keys % max(N, 1)).astype(np.int32),
+        post_tfs=tfs.astype(np.float32),
+    )
+
+def _kb_fingerprint(c) -> np.ndarray:
+    # chunks are only ever appended or cleared, and AUTOINCREMENT never reuses ids
+    return np.array(c.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM chunks").fetchone(), dtype=np.int64)
+
+def load_corpus(c) -> Corpus:
+    """
+    Corpus arrays cached next to the DB, falling back to a rebuild (which is cached).
+    The cache file carries the KB fingerprint it was built from and is only used on a match.
+    """
+    corpus = None
+    fp = _kb_fingerprint(c)
+    try:
+        with np.load(CORPUS_PATH) as z:
+            if np.array_equal(z["fingerprint"], fp):
+                corpus = Corpus(**{f.name: z[f.name] for f in fields(Corpus)})
+    except Exception:
+        pass    # missing, stale-format or corrupt cache: rebuild
+    if corpus is None:
+        corpus = build_corpus(c)
+        tmp = CORPUS_PATH + ".tmp"
+        with open(tmp, "wb") as out:
+            np.savez(out, fingerprint=fp, **{f.name: getattr(corpus, f.name) for f in fields(Corpus)})
+        os.replace(tmp, CORPUS_PATH)
+    return corpus
+
+def bm25_snapshot() -> Tuple[Corpus, Dict[str, int], np.ndarray, float]:
+    """
+    (corpus, vocab, idf, avgdl) for one KB state. Built together in a single read
+    transaction, so query terms, corpus term ids and the idf always agree.
+    """
+    global _CORPUS, _STATS
+    with _KB_LOCK:
+        corpus, stats = _CORPUS, _STATS
+        if corpus is None or stats is None:
+            c = db()
+            c.execute("BEGIN")
+            try:
+                corpus = load_corpus(c)
+                stats = _rebuild_stats(c)
+            finally:
+                c.commit()
+            _CORPUS, _STATS = corpus, stats
+    return (corpus,) + stats
+
+def drop_corpus():
+    global _CORPUS
+    _CORPUS = None
+    try:
+        os.remove(CORPUS_PATH)
+    except FileNotFoundError:
+        pass
+
+def _kth_page_score(scores, pages, idx, k):
+    # Lower bound on the k-th best per-(source,page) score so far, read off the
+    # top 4k of the scored chunks `idx`; 0.0 while those don't span k pages yet
+    if len(idx) > 4 * k:
+        idx = idx[np.argpartition(scores[idx], len(idx) - 4 * k)[len(idx) - 4 * k:]]
+    best = {}
+    for i in idx:
+        if scores[i] > best.get(pages[i], 0.0):
+            best[pages[i]] = scores[i]
+    if len(best) < k:
+        return 0.0
+    return float(sorted(best.values(), reverse=True)[k - 1])
+
+def bm25_rank(query_ids, corpus: Corpus, idf: np.ndarray, avgdl: float, k1=1.5, b=0.75, topk=4):
+    """
+    Term-at-a-time BM25 with MaxScore pruning: terms are scored in
+    descending upper bound, and once the bound left in the unscored terms
+    can no longer lift a chunk past the current k-th best page, only the
+    surviving candidates are looked up in the remaining posting lists.
+    """
+    terms = sorted((t for t in set(query_ids) if len(corpus.postings(t)[0])),
+                   key=lambda t: idf[t], reverse=True)
+    if topk <= 0 or not terms:
+        return []
+    # tf / (tf + k1*(...)) < 1, so a term adds at most idf * (k1 + 1)
+    remaining = float(idf[terms].sum()) * (k1 + 1.0)
+    scores = np.zeros(len(corpus.lens), dtype=np.float32)
+    cands = None    # sorted doc indices still able to reach the top-k
+    for t in terms:
+        dids, tfs = corpus.postings(t)
+        if cands is not None:
+            # skip straight to the candidates in this (sorted) posting list
+            pos = np.searchsorted(dids, cands)
+            hit = pos < len(dids)
+            hit[hit] = dids[pos[hit]] == cands[hit]
+            dids, tfs = cands[hit], tfs[pos[hit]]
+        denom = tfs + k1 * (1.0 - b + b * (corpus.lens[dids] / avgdl))
+        # doc indices are unique within one posting list, so a plain scatter-add is safe
+        scores[dids] += float(idf[t]) * (tfs * (k1 + 1.0) / denom)
+
+        remaining -= float(idf[t]) * (k1 + 1.0)
+        if remaining <= 0:
+            break
+        if remaining >= scores.max():
+            continue
+        theta = _kth_page_score(scores, corpus.pages, np.flatnonzero(scores) if cands is None else cands, topk)
+        if remaining < theta:
+            if cands is None:
+                cands = np.flatnonzero(scores + remaining >= theta)
+            else:
+                cands = cands[scores[cands] + remaining >= theta]
+
+    # Keep only the best chunk per (source,page); widen the partial sort until
+    # enough distinct pages turn up. Pruned docs hold partial scores and stay out.
+    cand = np.flatnonzero(scores > 0) if cands is None else cands[scores[cands] > 0]
+    m = topk
+    while True:
+        top = cand
+        if len(cand) > m:
+            # everything tied with the m-th score comes along, so ties break on chunk id
+            top = cand[scores[cand] >= np.partition(scores[cand], len(cand) - m)[len(cand) - m]]
+        top = top[np.lexsort((corpus.doc_ids[top], -scores[top]))]
+        best_per_page = {}
+        for i in top:
+            best_per_page.setdefault(corpus.pages[i], (float(scores[i]), int(corpus.doc_ids[i])))
+        if len(best_per_page) >= topk or len(top) == len(cand):
+            return list(best_per_page.values())[:topk]
+        m *= 2
 
 def safe_int(val, default=4):
     try:
@@ -60,6 +218,7 @@ def safe_int(val, default=4):
 
 
 DB_PATH = "app.db"
+CORPUS_PATH = os.path.splitext(DB_PATH)[0] + ".bm25.npz"   # Corpus arrays next to the DB
 # Tuning knobs (EXTREME SAFE)
 PAGE_LIMIT = 5          # process first 2 pages per PDF while testing
 CHUNK_SIZE = 1200       # bigger chunks => fewer rows
@@ -67,6 +226,9 @@ CHUNK_OVERLAP = 50      # less overlap => fewer rows
 MIN_CHARS = 20         # skip tiny fragments
 MAX_PAGE_CHARS = 120_000  # hard cap per page to avoid huge memory
 BATCH_INSERT = 50       # insert to DB every N chunks
+# start method for the extraction workers (fork is unsafe from a threaded server)
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
 
 
 app = Flask(__name__)
@@ -74,19 +236,43 @@ app.secret_key = os.getenv("FLASK_SECRET", "dev-secret")
 client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
 # ---------- DB ----------
-def db():
+def connect():
     c = sqlite3.connect(DB_PATH)
     c.row_factory = sqlite3.Row
+    # per-connection settings; journal_mode=WAL is persisted by init_db()
+    c.execute("PRAGMA synchronous=NORMAL;")
+    c.execute("PRAGMA temp_store=MEMORY;")
+    c.execute("PRAGMA mmap_size=268435456;")
     return c
 
+def db():
+    """
+    One connection per request, kept on flask.g and closed on teardown.
+    Outside a request a fresh connection is returned.
+    """
+    if not has_app_context():
+        return connect()
+    if "db" not in g:
+        g.db = connect()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exc):
+    c = g.pop("db", None)
+    if c is not None:
+        c.close()
+
 def init_db():
-    c = db()
+    c = connect()
+    c.execute("PRAGMA journal_mode=WAL;")
     c.execute("""
       CREATE TABLE IF NOT EXISTS chunks (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         source TEXT,
         page INTEGER,
-        chunk TEXT
+        chunk TEXT,
+        tokens BLOB,
+        n_tokens INTEGER
       );
     """)
     c.execute("""
@@ -101,13 +287,53 @@ def init_db():
         updated_at TEXT DEFAULT CURRENT_TIMESTAMP
       );
     """)
+    # Term ids (dense, from 0) and document frequency, maintained at ingest time by index_chunks()
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS term_vocab (
+        id INTEGER PRIMARY KEY,
+        term TEXT NOT NULL UNIQUE,
+        df INTEGER NOT NULL DEFAULT 0
+      );
+    """)
+    # list_tasks() ordering, and the per-page grouping in the retrieve() backfill / debug view
+    c.execute("CREATE INDEX IF NOT EXISTS tasks_order_idx ON tasks(status DESC, due_at, id DESC);")
+    c.execute("CREATE INDEX IF NOT EXISTS chunks_src_page ON chunks(source, page);")
+
+    # KBs indexed before chunks carried packed term ids: re-index them once
+    cols = {r["name"] for r in c.execute("PRAGMA table_info(chunks)")}
+    if "tokens" not in cols:
+        c.execute("ALTER TABLE chunks ADD COLUMN tokens BLOB;")
+        c.execute("ALTER TABLE chunks ADD COLUMN n_tokens INTEGER;")
+    if c.execute("SELECT 1 FROM chunks WHERE typeof(tokens) != 'blob' LIMIT 1").fetchone():
+        rows = c.execute("SELECT source, page, chunk FROM chunks ORDER BY id").fetchall()
+        c.execute("DELETE FROM chunks")
+        c.execute("DELETE FROM term_vocab")
+        index_chunks(c, rows, {})
+        c.execute("ANALYZE")
     c.commit(); c.close()
 
 # ---------- Utilities ----------
 _word_re = re.compile(r"[A-Za-z0-9']+")
+_ws_re = re.compile(r"\s+")
 
 def tokenize(text: str) -> List[str]:
-    return [w.lower() for w in _word_re.findall(text or "")]
+    text = text or ""
+    # One C-level lower() over ASCII text; elsewhere lower per token, since lowering the
+    # whole text can map non-ASCII letters (KELVIN SIGN -> 'k') into _word_re matches.
+    if text.isascii():
+        return _word_re.findall(text.lower())
+    return [w.lower() for w in _word_re.findall(text)]
+
+def load_vocab(c) -> Dict[str, int]:
+    """
+    term -> id as committed in term_vocab. Writers load it inside their write
+    transaction, so no other ingest can hand out ids in the meantime.
+    """
+    return {r["term"]: r["id"] for r in c.execute("SELECT id, term FROM term_vocab")}
+
+def query_term_ids(tokens: List[str], vocab: Dict[str, int]) -> List[int]:
+    # unknown terms can't match anything, so they are dropped
+    return [vocab[t] for t in set(tokens) if t in vocab]
 
 def chunk_text(text: str, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
     """
@@ -115,156 +341,208 @@ def chunk_text(text: str, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
     """
     if not text:
         return
-    # Normalize whitespace early
-    text = " ".join(text.split())
+    # Normalize whitespace early (one C-level pass, no intermediate word list)
+    text = _ws_re.sub(" ", text).strip()
     # Hard cap to avoid huge pages (some PDFs have page-level text > 1–5 MB)
     if len(text) > MAX_PAGE_CHARS:
         text = text[:MAX_PAGE_CHARS]
 
-    n = len(text)
-    i = 0
-    while i < n:
-        j = min(i + size, n)
-        piece = text[i:j]
-        if len(piece) >= MIN_CHARS:
-            yield piece
-        if j == n:
-            break
-        # advance window with overlap protection
-        nxt = j - overlap
-        i = nxt if nxt > i else j
+    # Full-size windows start every `step` chars while they end before the
+    # text does; the window that reaches the end is the tail.
+    step = size - overlap if overlap < size else size
+    full = range(0, len(text) - size, step)
+    if size >= MIN_CHARS:
+        for i in full:
+            yield text[i:i + size]
+    tail = text[len(full) * step:]
+    if len(tail) >= MIN_CHARS:
+        yield tail
 
 
 # ---------- Indexing (very light) ----------
-def index_pdf(file_storage, page_limit: int | None = PAGE_LIMIT) -> int:
+def index_chunks(c, rows, vocab: Dict[str, int]):
     """
-    Stream page -> chunk generator -> small batch inserts.
-    Keeps memory usage very low.
+    Insert (source, page, chunk) rows together with their tokens packed as
+    uint32 term ids, and add their document frequencies to term_vocab.
+    New terms are interned into `vocab` with the next dense id.
+    Caller owns the connection and commits.
     """
-    name = file_storage.filename
-    reader = PdfReader(file_storage.stream)
-
-    total_added = 0
-    batch = []
-
-    def flush_batch():
-        nonlocal batch, total_added
-        if not batch:
-            return
-        c = db()
-        c.executemany("INSERT INTO chunks (source, page, chunk) VALUES (?, ?, ?)", batch)
-        c.commit(); c.close()
-        total_added += len(batch)
-        batch = []
+    batch, df = [], Counter()
+    for source, page, text in rows:
+        toks = tokenize(text)
+        ids = np.array([vocab.setdefault(t, len(vocab)) for t in toks], dtype=np.uint32)
+        batch.append((source, page, text, ids.tobytes(), len(ids)))
+        df.update(set(toks))
+    c.executemany("INSERT INTO chunks (source, page, chunk, tokens, n_tokens) VALUES (?, ?, ?, ?, ?)", batch)
+    c.executemany(
+        "INSERT INTO term_vocab (id, term, df) VALUES (?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET df = df + excluded.df",
+        [(vocab[t], t, n) for t, n in df.items()]
+    )
+
+def pdf_pages(data: bytes, page_limit: int | None = PAGE_LIMIT):
+    """
+    Returns (total_pages, iterable of page texts) using PyMuPDF if installed,
+    else poppler's `pdftotext` if on PATH, else pypdf.
+    total_pages is None when pdftotext stopped at page_limit.
+    """
+    if pymupdf is not None:
+        doc = pymupdf.open(stream=data, filetype="pdf")
+        n = min(doc.page_count, page_limit) if page_limit else doc.page_count
 
-    total_pages = len(reader.pages)
-    max_pages = min(total_pages, page_limit) if page_limit else total_pages
-    print(f"[INDEX] {name}: {total_pages} pages (processing first {max_pages})")
+        def texts():
+            try:
+                for i in range(n):
+                    yield doc[i].get_text("text")
+            finally:
+                doc.close()
+        return doc.page_count, texts()
+
+    if shutil.which("pdftotext"):
+        cmd = ["pdftotext", "-layout"] + (["-l", str(page_limit)] if page_limit else []) + ["-", "-"]
+        out = subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+        # one form feed after every page
+        pages = out.decode("utf-8", errors="replace").split("\f")[:-1]
+        return (None if page_limit else len(pages)), pages
+
+    reader = PdfReader(io.BytesIO(data))
+    n = min(len(reader.pages), page_limit) if page_limit else len(reader.pages)
+    return len(reader.pages), (reader.pages[i].extract_text() or "" for i in range(n))
+
+def extract_chunks(data: bytes, name: str, page_limit: int | None = PAGE_LIMIT) -> List[Tuple[str, int, str]]:
+    """
+    PDF bytes -> (source, page, chunk) rows. Touches no DB or app state,
+    so it can run in a worker process.
+    """
+    total_pages, pages = pdf_pages(data, page_limit)
+    max_pages = min(total_pages or page_limit, page_limit) if page_limit else total_pages
+    print(f"[INDEX] {name}: {total_pages or '?'} pages (processing first {max_pages})")
 
+    rows = []
     try:
-        for pi, page in enumerate(reader.pages, start=1):
-            if page_limit and pi > page_limit:
-                break
-
-            # Extract text (might be very large if PDF is odd)
-            txt = page.extract_text() or ""
-            # Stream chunks; don't accumulate more than BATCH_INSERT at once
+        # Page text might be very large if PDF is odd
+        for pi, txt in enumerate(pages, start=1):
             page_added = 0
             for ch in chunk_text(txt):
-                batch.append((name, pi, ch))
-                if len(batch) >= BATCH_INSERT:
-                    flush_batch()
+                rows.append((name, pi, ch))
                 page_added += 1
-
             print(f"[INDEX] {name}: page {pi}/{max_pages} -> {page_added} chunks")
-        # flush remaining
-        flush_batch()
-
     except MemoryError:
-        # Flush anything pending, then bail out gracefully
-        try:
-            flush_batch()
-        except Exception:
-            pass
+        # Keep what we extracted so far, then bail out gracefully
         print("[INDEX][ERROR] MemoryError while indexing; partial data was saved.")
-        # Return what we did save so far
-        return total_added
+    return rows
 
-    print(f"[INDEX] {name}: wrote {total_added} chunks total")
-    return total_added
+def insert_chunks(name: str, rows: List[Tuple[str, int, str]]) -> int:
+    """
+    Write extracted rows in BATCH_INSERT slices; the whole PDF is one transaction.
+    """
+    if not rows:
+        # scanned / image-only PDF: the KB is unchanged, so keep cached corpus and results
+        print(f"[INDEX] {name}: no text extracted")
+        return 0
+    c = db()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        vocab = load_vocab(c)
+        for i in range(0, len(rows), BATCH_INSERT):
+            index_chunks(c, rows[i:i + BATCH_INSERT], vocab)
+        c.commit()
+    except Exception:
+        c.rollback()
+        raise
+    _kb_changed()
+    print(f"[INDEX] {name}: wrote {len(rows)} chunks total")
+    return len(rows)
 
+def index_pdf(file_storage, page_limit: int | None = PAGE_LIMIT) -> int:
+    name = file_storage.filename
+    return insert_chunks(name, extract_chunks(file_storage.read(), name, page_limit))
 
-# ---------- Retrieval (keyword score; no ML) ----------
-def score_chunk(query_tokens: List[str], chunk_text: str) -> int:
-    if not query_tokens or not chunk_text:
-        return 0
-    ctoks = set(tokenize(chunk_text))
-    # Simple overlap score (can be improved later)
-    return sum(1 for t in query_tokens if t in ctoks)
 
+# ---------- Retrieval (BM25; no ML) ----------
 def retrieve(query: str, k: int = 4) -> List[Dict]:
-    q_tokens = tokenize(query)
-    c = db()
-    rows = c.execute("SELECT source, page, chunk FROM chunks").fetchall()
-    c.close()
+    # Ranking only sees the set of query terms, so that is the cache key
+    q_norm = " ".join(sorted(set(tokenize(query))))
+    return [dict(r) for r in _retrieve_cached(q_norm, k, _CORPUS_VERSION)]
+
+# Every page is ranked, so pages no query term hits follow in KB order, each by its first chunk
+_FILL_FIRST = (
+    "SELECT id, source, page, chunk FROM chunks "
+    "WHERE id IN (SELECT MIN(id) FROM chunks GROUP BY source, page) ORDER BY id LIMIT ?"
+)
+# No query terms at all: one longest chunk per (source,page), longest pages first;
+# ties go to the earlier chunk, and between pages to the page seen first
+_FILL_LONGEST = (
+    "SELECT c.id, c.source, c.page, c.chunk FROM chunks c JOIN ("
+    "  SELECT id, n, first_id FROM ("
+    "    SELECT id, LENGTH(chunk) AS n,"
+    "      ROW_NUMBER() OVER (PARTITION BY source, page ORDER BY LENGTH(chunk) DESC, id) AS rn,"
+    "      MIN(id) OVER (PARTITION BY source, page) AS first_id"
+    "    FROM chunks)"
+    "  WHERE rn = 1 ORDER BY n DESC, first_id LIMIT ?"
+    ") t ON c.id = t.id ORDER BY t.n DESC, t.first_id"
+)
+
+@lru_cache(maxsize=256)
+def _retrieve_cached(q_norm: str, k: int, version: int) -> Tuple[Dict, ...]:
+    """
+    Results per (query terms, k, corpus version); a KB change bumps the
+    version, so stale entries are never hit and age out of the LRU.
+    """
+    q_tokens = q_norm.split()
+    corpus, vocab, idf, avgdl = bm25_snapshot()
 
     # If DB empty
-    if not rows:
-        return []
+    if not len(corpus.lens):
+        return ()
 
     # Try BM25 first if we have a query
     results = []
+    c = db()
     if q_tokens:
-        docs = build_corpus(rows)
-        results = bm25_rank(q_tokens, docs, k1=1.5, b=0.75, topk=k)
+        ranked = bm25_rank(query_term_ids(q_tokens, vocab), corpus, idf, avgdl, k1=1.5, b=0.75, topk=k)
+        # Chunk text is fetched for the top-k only
+        ids = [doc_id for _, doc_id in ranked]
+        marks = ",".join("?" * len(ids))
+        texts = {r["id"]: r for r in c.execute(f"SELECT id, source, page, chunk FROM chunks WHERE id IN ({marks})", ids)}
+        results = [
+            {"source": texts[doc_id]["source"], "page": texts[doc_id]["page"],
+             "chunk": texts[doc_id]["chunk"], "score": round(s,4)}
+            for s, doc_id in ranked
+            if doc_id in texts      # gone if a clear landed after the snapshot
+        ]
 
-    # Backfill if matches are too weak or empty:
+    # Backfill if matches are too weak or empty, picked by SQLite so the KB never lands in Python
     if len(results) < k:
-        # one longest chunk per (source,page)
-        best_by_len = {}
-        for r in rows:
-            key = (r["source"], r["page"])
-            cur = best_by_len.get(key)
-            if (cur is None) or (len(r["chunk"]) > len(cur["chunk"])):
-                best_by_len[key] = r
         already = {(x["source"], x["page"]) for x in results}
+        rows = c.execute(_FILL_FIRST if q_tokens else _FILL_LONGEST, (k + len(results),)).fetchall()
         fillers = [
-            {"source": v["source"], "page": v["page"], "chunk": v["chunk"], "score": 0.0}
-            for k2, v in sorted(best_by_len.items(), key=lambda kv: len(kv[1]["chunk"]), reverse=True)
-            if k2 not in already
+            {"source": r["source"], "page": r["page"], "chunk": r["chunk"], "score": 0.0}
+            for r in rows
+            if (r["source"], r["page"]) not in already
         ]
         results.extend(fillers[: max(0, k - len(results))])
 
-    return results
+    return tuple(results)
 
 # --- Bullet formatting helper ---
 # --- Bullet formatting helper ---
+_line_ws_re = re.compile(r"^[^\S\n]+|[^\S\n]+$", re.M)
+_bullet_run_re = re.compile(r"^\* .+(?:\n\* .+)*$", re.M)
+_bullet_re = re.compile(r"^\* [^\S\n]*(.+)$", re.M)
+
+
+def _bullet_list(m: re.Match) -> str:
+    return "<ul>\n" + _bullet_re.sub(r"<li>\1</li>", m.group(0)) + "\n</ul>"
+
+
 def format_bullets(text: str) -> str:
     """
     Convert lines starting with '*' into <li> HTML bullet points.
     Supports multi-line answers gracefully.
     """
-    lines = text.split("\n")
-    items = []
-    ul_open = False
-
-    for ln in lines:
-        striped = ln.strip()
-        if striped.startswith("* "):
-            if not ul_open:
-                items.append("<ul>")
-                ul_open = True
-            items.append(f"<li>{striped[2:].strip()}</li>")
-        else:
-            if ul_open:
-                items.append("</ul>")
-                ul_open = False
-            items.append(striped)
-
-    if ul_open:
-        items.append("</ul>")
-
-    return "<br>".join(items)
+    text = _line_ws_re.sub("", text)
+    return _bullet_run_re.sub(_bullet_list, text).replace("\n", "<br>")
 
 
 # ---------- Answer (Groq) ----------
@@ -275,7 +553,6 @@ def answer(query: str, k: int = 4, model: str = "llama-3.1-8b-instant"):
     if not ctx:
         c = db()
         r = c.execute("SELECT source, page, chunk FROM chunks LIMIT 4").fetchall()
-        c.close()
         ctx = [{"source": x["source"], "page": x["page"], "chunk": x["chunk"], "score": 0} for x in r]
 
     context_txt = "\n\n".join([f"[Source: {c['source']} p{c['page']}]\n{c['chunk']}" for c in ctx]) or "(no relevant context found)"
@@ -313,29 +590,30 @@ def add_task(title: str, notes: str, due_iso: str, priority: str):
     c = db()
     c.execute("INSERT INTO tasks(title,notes,due_at,priority,status) VALUES (?,?,?,?, 'todo')",
               (title, notes, due_iso, priority))
-    c.commit(); c.close()
+    c.commit()
 
 def list_tasks():
     c = db()
     rows = c.execute("SELECT * FROM tasks ORDER BY status DESC, due_at ASC, id DESC").fetchall()
-    c.close()
     return rows
 
 def mark_done(task_id: int):
     c = db()
     c.execute("UPDATE tasks SET status='done', updated_at=CURRENT_TIMESTAMP WHERE id=?", (task_id,))
-    c.commit(); c.close()
+    c.commit()
 
 def delete_task(task_id: int):
     c = db()
     c.execute("DELETE FROM tasks WHERE id=?", (task_id,))
-    c.commit(); c.close()
+    c.commit()
 
 
 def clear_kb():
     c = db()
     c.execute("DELETE FROM chunks")
-    c.commit(); c.close()
+    c.execute("DELETE FROM term_vocab")
+    c.commit()
+    _kb_changed()
 
 # --- KB preview (see what’s indexed) ---
 def list_chunks(limit=200):
@@ -345,7 +623,6 @@ def list_chunks(limit=200):
         "FROM chunks ORDER BY source, page LIMIT ?",
         (limit,)
     ).fetchall()
-    c.close()
     return rows
 
 
@@ -368,16 +645,36 @@ def do_index():
             return redirect(url_for("home"))
 
         total = 0
-        for f in files:
-            try:
-                total += index_pdf(f, page_limit=PAGE_LIMIT)
-            except MemoryError:
-                flash("Memory limit reached while indexing. Try smaller PDFs or keep PAGE_LIMIT low.")
-                break
-            except Exception as e:
-                print("[INDEX][ERROR]", traceback.format_exc())
-                flash(f"Index error: {e}")
-                break
+        jobs = [(f.read(), f.filename) for f in files]
+        # Extraction is CPU-bound and per-PDF independent: one worker process per PDF,
+        # inserts stay here. A single PDF skips the process start-up cost.
+        workers = min(len(jobs), os.cpu_count() or 1)
+        if len(jobs) > 1:
+            # never fork: this request thread shares the process with other request threads
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT)
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+        done = False
+        try:
+            futures = [pool.submit(extract_chunks, data, name, PAGE_LIMIT) for data, name in jobs]
+            for (_, name), fut in zip(jobs, futures):
+                try:
+                    total += insert_chunks(name, fut.result())
+                except MemoryError:
+                    flash("Memory limit reached while indexing. Try smaller PDFs or keep PAGE_LIMIT low.")
+                    break
+                except Exception as e:
+                    print("[INDEX][ERROR]", traceback.format_exc())
+                    flash(f"Index error: {e}")
+                    break
+            else:
+                done = True
+        finally:
+            # after an early stop, don't hold the request for extractions nobody will insert
+            pool.shutdown(wait=done, cancel_futures=True)
+        if total:
+            # Refresh planner statistics once per upload, not per PDF
+            db().execute("ANALYZE")
 
         flash(f"Indexed {total} chunks.")
         return redirect(url_for("home"))
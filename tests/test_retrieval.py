@@ -0,0 +1,111 @@
+import os
+import random
+
+os.environ.setdefault("GROQ_API_KEY", "test")   # the Groq client is built at import
+
+import numpy as np
+import pytest
+
+import app_flask as A
+
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    monkeypatch.setattr(A, "DB_PATH", str(tmp_path / "app.db"))
+    monkeypatch.setattr(A, "CORPUS_PATH", str(tmp_path / "app.bm25.npz"))
+    A._kb_changed()
+    A.init_db()
+    with A.app.app_context():
+        yield
+    A._kb_changed()
+
+
+def zipf_rows(rng, n_docs, vocab, n_sources=40, n_pages=8):
+    rows = []
+    for _ in range(n_docs):
+        ids = np.minimum(rng.zipf(1.3, int(rng.integers(5, 120))), len(vocab)) - 1
+        rows.append((f"s{rng.integers(n_sources)}.pdf", int(rng.integers(n_pages)), " ".join(vocab[i] for i in ids)))
+    return rows
+
+
+def exhaustive_rank(query_ids, corpus, idf, avgdl, k1=1.5, b=0.75, topk=4):
+    # bm25_rank without pruning: every posting of every term, same float32 arithmetic
+    terms = sorted((t for t in set(query_ids) if len(corpus.postings(t)[0])), key=lambda t: idf[t], reverse=True)
+    scores = np.zeros(len(corpus.lens), dtype=np.float32)
+    for t in terms:
+        dids, tfs = corpus.postings(t)
+        denom = tfs + k1 * (1.0 - b + b * (corpus.lens[dids] / avgdl))
+        scores[dids] += float(idf[t]) * (tfs * (k1 + 1.0) / denom)
+    best = {}
+    for i in sorted(np.flatnonzero(scores), key=lambda i: (-scores[i], corpus.doc_ids[i])):
+        best.setdefault(corpus.pages[i], (float(scores[i]), int(corpus.doc_ids[i])))
+    return list(best.values())[:topk]
+
+
+def test_pruned_rank_matches_exhaustive(kb, monkeypatch):
+    rng = np.random.default_rng(0)
+    vocab = [f"w{i}" for i in range(3000)]
+    A.insert_chunks("zipf", zipf_rows(rng, 3000, vocab))
+    corpus, terms, idf, avgdl = A.bm25_snapshot()
+
+    pruned = []
+    kth = A._kth_page_score
+    def spy(*args):
+        theta = kth(*args)
+        pruned.append(theta > 0)
+        return theta
+    monkeypatch.setattr(A, "_kth_page_score", spy)
+
+    for _ in range(300):
+        words = [vocab[i] for i in np.minimum(rng.zipf(1.2, int(rng.integers(1, 8))), 500) - 1]
+        q = A.query_term_ids(words, terms)
+        for k in (1, 4, 10):
+            assert A.bm25_rank(q, corpus, idf, avgdl, topk=k) == exhaustive_rank(q, corpus, idf, avgdl, topk=k)
+    assert any(pruned)     # the MaxScore threshold was actually in play
+
+
+def baseline_fillers(rows, hits, by_length):
+    # baseline retrieve(): pages nothing matched fill the rest in KB order (first chunk);
+    # a query without terms takes one longest chunk per page, longest first
+    pages = {}
+    for cid, (source, page, chunk) in enumerate(rows, 1):
+        pages.setdefault((source, page), []).append((cid, chunk))
+    if by_length:
+        picks = []
+        for key, chunks in pages.items():
+            longest = max(len(c) for _, c in chunks)
+            chunk = next(c for _, c in chunks if len(c) == longest)
+            picks.append((-longest, chunks[0][0], key, chunk))
+        return [(key, chunk) for _, _, key, chunk in sorted(picks)]
+    return [(key, chunks[0][1]) for key, chunks in pages.items() if key not in hits]
+
+
+@pytest.mark.parametrize("query", ["", "?!", "zzz", "apple", "apple kiwi"])
+def test_fillers_follow_baseline_rules(kb, query):
+    rnd = random.Random(7)
+    words = [f"w{i}" for i in range(200)]
+    rows = []
+    for i in range(400):
+        # few distinct lengths, so ties decide the order
+        toks = rnd.choices(words, k=rnd.choice([3, 3, 5, 8]))
+        if i % 97 == 0:
+            toks.append(rnd.choice(["apple", "kiwi"]))
+        rows.append((f"s{rnd.randrange(15)}.pdf", rnd.randrange(4), " ".join(toks)))
+    A.insert_chunks("fill", rows)
+
+    for k in (1, 5, 30, 100):
+        got = A.retrieve(query, k)
+        hits = [((r["source"], r["page"]), r["chunk"]) for r in got if r["score"] > 0]
+        zeros = [((r["source"], r["page"]), r["chunk"]) for r in got if r["score"] == 0.0]
+        assert got[:len(hits)] == [r for r in got if r["score"] > 0]
+        expected = baseline_fillers(rows, {key for key, _ in hits}, by_length=not A.tokenize(query))
+        assert zeros == expected[:k - len(hits)]
+
+
+def test_empty_pdf_keeps_cached_state(kb):
+    A.insert_chunks("a.pdf", [("a.pdf", 1, "apple banana cherry")])
+    A.retrieve("apple")
+    version, corpus = A._CORPUS_VERSION, A._CORPUS
+    assert A.insert_chunks("scan.pdf", []) == 0
+    assert A._CORPUS_VERSION == version and A._CORPUS is corpus
+    assert os.path.exists(A.CORPUS_PATH)